@@ -0,0 +1,10 @@
+# セッションのキャッシュやスケジュールはプロセス内に持っているので、ワーカーは1つにしてスレッドで並列に処理する
+bind = "0.0.0.0:8080"
+workers = 1
+worker_class = "gthread"
+threads = 8
+
+def post_worker_init(worker):
+	import main
+	# ワーカーが再起動されたときはデプロイの通知を送り直さない
+	main.start_scheduler(notify=worker.age == 1)
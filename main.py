@@ -21,14 +21,73 @@ from linebot.models import (
 	MessageTemplateAction
 )
 
-import os,re,datetime,schedule,time
+import os,datetime,sched,time,threading
+import cachetools
 from textwrap import dedent
 import pymysql.cursors
+import pymysqlpool
 from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
 line_bot_api = LineBotApi(os.environ["CHANNEL_ACCESS_TOKEN"])
 handler = WebhookHandler(os.environ["CHANNEL_SECRET"])
+my_user_id = os.environ["MY_USER_ID"]
+# webhookのスレッド(gunicorn.conf.pyのthreads)とpush_executorのワーカーが同時に1本ずつ使っても足りる数にしておく
+pool = pymysqlpool.ConnectionPool(size=17,
+								maxsize=20,
+								pre_create_num=2,
+								name="reminder",
+								# MariaDBのwait_timeout(既定28800秒)より前に作り直し、サーバ側で切られた接続を使わないようにする
+								con_lifetime=3600,
+								autocommit=True,
+								host=os.environ["NS_MARIADB_HOSTNAME"],
+								port=int(os.environ["NS_MARIADB_PORT"]),
+								user=os.environ["NS_MARIADB_USER"],
+								password=os.environ["NS_MARIADB_PASSWORD"],
+								db=os.environ["NS_MARIADB_DATABASE"],
+								charset='utf8mb4',
+								cursorclass=pymysql.cursors.DictCursor)
+# user_sessionの内容はこのプロセス内でしか更新されないのでキャッシュしておく
+session_cache = cachetools.TTLCache(maxsize=10000, ttl=3600)
+session_cache_lock = threading.Lock()
+# キャッシュへ書き込むたびに増やす。SELECT中に書き込みがあった場合は読んだ値をキャッシュしない
+session_generation = 0
+# ジョブが追加されるとwakeがセットされ、スケジューラの待機が解除される
+wake = threading.Event()
+
+def wait_for_job(timeout):
+	wake.wait(timeout)
+	wake.clear()
+
+scheduler = sched.scheduler(time.time, wait_for_job)
+# スヌーズ時に取り消せるよう、delete_historyのジョブを(user_id, text_id)で引けるようにしておく
+# (探索がなくなるだけで、scheduler.cancel()自体はキューの削除と再ヒープ化でO(N)かかる)
+delete_jobs = {}
+# LINEへのpushやスケジュールされた処理は、スケジューラやwebhookの応答を待たせないよう別スレッドで行う
+push_executor = ThreadPoolExecutor(max_workers=8)
+
+HOW_TO_USE_REPLY = TextSendMessage(text=dedent("""\
+	まず、リマインドしたいことを教えてください!
+	その後にリマインドして欲しい日時を教えてください!\n
+	日時の指定では3つのフォーマットがあります
+	・HH:MM
+	・mm/dd HH:MM
+	・YYYY/mm/dd HH:MM
+	明示的に示さなかった部分は現在の値となります
+	「一覧」と入力することで現在登録されているリマインドを確認できます
+	また、「取り消し」と入力すると登録したリマインドを削除できます
+	さらに、「スヌーズ」と入力すると前回リマインドした内容を再び設定できます"""),
+	quick_reply=QuickReply(items=[
+		QuickReplyButton(action=MessageAction(label="一覧", text="一覧")),
+		QuickReplyButton(action=MessageAction(label="取り消し", text="取り消し")),
+		QuickReplyButton(action=MessageAction(label="スヌーズ", text="スヌーズ"))]))
+CANCEL_QUICK_REPLY = QuickReply(items=[
+	QuickReplyButton(action=MessageAction(label="キャンセル", text="キャンセル"))])
+CANCEL_OR_RESEND_QUICK_REPLY = QuickReply(items=[
+	QuickReplyButton(action=MessageAction(label="キャンセル", text="キャンセル")),
+	QuickReplyButton(action=MessageAction(label="再送", text="再送"))])
+SNOOZE_QUICK_REPLY = QuickReply(items=[
+	QuickReplyButton(action=MessageAction(label="スヌーズ", text="スヌーズ"))])
 
 @app.route("/")
 def hello_world():
@@ -38,105 +97,73 @@ def hello_world():
 def callback():
 	signature = request.headers['X-Line-Signature']
 	body = request.get_data(as_text=True)
-	app.logger.info("Request body: " + body)
+	app.logger.debug("Request body: %s", body)
 	try:
 		handler.handle(body, signature)
-		return 'OK'
 	except InvalidSignatureError:
 		print("Invalid signature. Please check your channel access token/channel secret.")
 		abort(400)
-		return 'OK'
+	return 'OK'
 
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
-	connection = get_connection()
 	user_id = event.source.user_id
 	text = event.message.text
-	text_id = event.message.id
-	with connection:
-		with connection.cursor() as cursor:
-			sql = "SELECT `status` FROM `user_session` WHERE `user_id`=%s"
-			cursor.execute(sql, (user_id))
-			user_status = cursor.fetchone()
-			if text == "使い方":
-				how_to_use = """\
-					まず、リマインドしたいことを教えてください!
-					その後にリマインドして欲しい日時を教えてください!\n
-					日時の指定では3つのフォーマットがあります
-					・HH:MM
-					・mm/dd HH:MM
-					・YYYY/mm/dd HH:MM
-					明示的に示さなかった部分は現在の値となります
-					「一覧」と入力することで現在登録されているリマインドを確認できます
-					また、「取り消し」と入力すると登録したリマインドを削除できます
-					さらに、「スヌーズ」と入力すると前回リマインドした内容を再び設定できます"""
-				line_bot_api.reply_message(
-						event.reply_token,
-						TextSendMessage(text=dedent(how_to_use),
-						quick_reply=QuickReply(items=[
-                        QuickReplyButton(action=MessageAction(label="一覧", text="一覧")),
-						QuickReplyButton(action=MessageAction(label="取り消し", text="取り消し")),
-						QuickReplyButton(action=MessageAction(label="スヌーズ", text="スヌーズ"))
-                    ])))
-			elif text == "一覧":
-				sql = "SELECT `remind_content`, `remind_time` FROM `reminder_content` WHERE `user_id`=%s"
-				cursor.execute(sql, (user_id))
+	# 使い方と一覧はステータスに関係なく応答するので、ステータスを読む前に処理する
+	if text == "使い方":
+		line_bot_api.reply_message(
+				event.reply_token,
+				HOW_TO_USE_REPLY)
+	elif text == "一覧":
+		connection = get_connection()
+		with connection:
+			with connection.cursor() as cursor:
+				sql = "SELECT `remind_content`, `remind_time` FROM `reminder_content` WHERE `user_id`=%s AND `remind_time` >= %s ORDER BY `remind_time`"
+				cursor.execute(sql, (user_id, datetime.datetime.now()))
 				remind_content_list = cursor.fetchall()
-				if len(remind_content_list) == 0:
-					line_bot_api.reply_message(
-						event.reply_token,
-						TextSendMessage(text="現在登録されているリマインドはありません"))
-				else:
-					remind_list = ""
-					for content_dict in remind_content_list:
-						remind_content = content_dict["remind_content"]
-						remind_time_dt = content_dict["remind_time"]
-						if remind_time_dt is None:
-							continue
-						remind_time_sec = remind_time_dt.timestamp()-time.time()
-						if remind_time_sec < 0:
-							continue
-						else:
-							# remind_time = re.sub("-","/",remind_time)
-							remind_time = remind_time_dt.strftime("%Y/%m/%d %H:%M")
-							remind_list += f'{remind_time} \n{remind_content}\n\n'
-					if remind_list == "":
-						line_bot_api.reply_message(
-							event.reply_token,
-							TextSendMessage(text="現在登録されているリマインドはありません"))
-					else:
-						remind_list = re.sub("\n\n$","",remind_list)
-						line_bot_api.reply_message(
-						event.reply_token,
-						TextSendMessage(text=remind_list))
-			# リマインダーの登録
-			elif user_status["status"] == 0:
-				if text == "スヌーズ":
-					snooze_remind(event)
-				else:
-					handle_status_0(event)
-			# 時刻の入力
-			elif user_status["status"] == 1:
-				handle_status_1(event)
-			# リマインダーの取り消しの選択
-			elif user_status["status"] == 2:
-				handle_status_2(event)
+		if len(remind_content_list) == 0:
+			line_bot_api.reply_message(
+				event.reply_token,
+				TextSendMessage(text="現在登録されているリマインドはありません"))
+		else:
+			remind_list = "\n\n".join(
+				f'{content_dict["remind_time"]:%Y/%m/%d %H:%M} \n{content_dict["remind_content"]}'
+				for content_dict in remind_content_list)
+			line_bot_api.reply_message(
+				event.reply_token,
+				TextSendMessage(text=remind_list))
+	else:
+		user_status = get_session(user_id)
+		# リマインダーの登録
+		if user_status["status"] == 0:
+			if text == "スヌーズ":
+				snooze_remind(event)
+			else:
+				handle_status_0(event)
+		# 時刻の入力
+		elif user_status["status"] == 1:
+			handle_status_1(event)
+		# リマインダーの取り消しの選択
+		elif user_status["status"] == 2:
+			handle_status_2(event)
 
 @handler.add(FollowEvent)
 def handle_follow(event):
+	user_id = event.source.user_id
+	run_background(send_message, my_user_id, "フォローされました")
 	connection = get_connection()
 	with connection:
 		with connection.cursor() as cursor:
-			user_id = event.source.user_id
-			send_message(my_user_id, "フォローされました")
-			line_bot_api.reply_message(
-						event.reply_token,
-						[TextSendMessage(text="このbotはデモ版です。個人情報等などは登録しないで下さい。"),
-						TextSendMessage(text="また、MessagingAPIの無料枠の関係上、本格的な利用は不可能です。一か月あたり全体で多くとも200回のリマインドしか送れません。"),
-						TextSendMessage(text="使い方を知りたい場合「使い方」と入力してください。")])
 			sql = "INSERT INTO `user_session` (`user_id`, `status`) VALUES (%s, %s)"
 			cursor.execute(sql, (user_id, 0))
-			connection.commit()
+			set_session(user_id, {"status": 0, "text_id": None, "last_notify_text_id": None})
+	# LINE APIの例外でプールの接続が失われないよう、返信は接続を返してから行う
+	line_bot_api.reply_message(
+				event.reply_token,
+				TextSendMessage(text="\n\n".join([
+					"このbotはデモ版です。個人情報等などは登録しないで下さい。",
+					"また、MessagingAPIの無料枠の関係上、本格的な利用は不可能です。一か月あたり全体で多くとも200回のリマインドしか送れません。",
+					"使い方を知りたい場合「使い方」と入力してください。"])))
 
 @handler.add(UnfollowEvent)
 def handle_unfollow(event):
@@ -144,13 +171,12 @@ def handle_unfollow(event):
 	with connection:
 		with connection.cursor() as cursor:
 			user_id = event.source.user_id
-			send_message(my_user_id, "アンフォローされました")
+			run_background(send_message, my_user_id, "アンフォローされました")
 			sql = "DELETE FROM `reminder_content` WHERE `user_id`=%s"
-			cursor.execute(sql, (user_id))
-			connection.commit()
+			cursor.execute(sql, (user_id,))
 			sql = "DELETE FROM `user_session` WHERE `user_id`=%s"
-			cursor.execute(sql, (user_id))
-			connection.commit()
+			cursor.execute(sql, (user_id,))
+			delete_session(user_id)
 
 @handler.add(PostbackEvent)
 def on_postback(event):
@@ -158,29 +184,28 @@ def on_postback(event):
 	connection = get_connection()
 	with connection:
 		with connection.cursor() as cursor:
-			sql = "SELECT `status` FROM `user_session` WHERE `user_id`=%s"
-			cursor.execute(sql, (user_id))
-			status = cursor.fetchone()["status"]
-			if status == 1:
+			user_session = get_session(user_id, cursor)
+			if user_session["status"] == 1:
 				remind_time_str = event.postback.params["datetime"]
 				remind_time = datetime.datetime.strptime(remind_time_str, "%Y-%m-%dT%H:%M")
-				sql = "SELECT `text_id` FROM `user_session` WHERE `user_id`=%s"
-				cursor.execute(sql, (user_id))
-				text_id = cursor.fetchone()["text_id"]
-				sql = "UPDATE `reminder_content` SET `remind_time`=%s WHERE `user_id`=%s AND `text_id`=%s"
-				cursor.execute(sql, (remind_time, user_id, text_id))
-				connection.commit()
-				sql = "UPDATE `user_session` SET `status`=0 WHERE `user_id`=%s"
-				cursor.execute(sql, (user_id))
-				connection.commit()
-				schedule.every(remind_time.timestamp()-time.time()).seconds.do(remind,text_id,user_id)
-				line_bot_api.reply_message(
-					event.reply_token,
-					TextSendMessage(text=f'登録できました!\n{remind_time.strftime("%Y/%m/%d %H:%M")}にリマインドします'))
+				text_id = user_session["text_id"]
+				connection.begin()
+				try:
+					sql = "UPDATE `reminder_content` SET `remind_time`=%s WHERE `user_id`=%s AND `text_id`=%s"
+					cursor.execute(sql, (remind_time, user_id, text_id))
+					sql = "UPDATE `user_session` SET `status`=0 WHERE `user_id`=%s"
+					cursor.execute(sql, (user_id,))
+					connection.commit()
+				except Exception:
+					# 再利用される接続だとプールに戻すときに途中までの変更がコミットされてしまう
+					connection.rollback()
+					raise
+				update_session_cache(user_id, status=0)
+				add_job(remind_time.timestamp(), run_background, (remind, text_id, user_id))
+				reply = TextSendMessage(text=f'登録できました!\n{remind_time.strftime("%Y/%m/%d %H:%M")}にリマインドします')
 			else:
-				line_bot_api.reply_message(
-					event.reply_token,
-					TextSendMessage(text=f"無効な日付選択アクションです"))
+				reply = TextSendMessage(text=f"無効な日付選択アクションです")
+	line_bot_api.reply_message(event.reply_token, reply)
 
 def handle_status_0(event):
 	connection = get_connection()
@@ -190,158 +215,160 @@ def handle_status_0(event):
 	with connection:
 		with connection.cursor() as cursor:
 			if text == "取り消し":
-				sql = "SELECT `remind_content`, `remind_time` FROM `reminder_content` WHERE `user_id`=%s"
-				cursor.execute(sql, (user_id))
+				sql = "SELECT `remind_content`, `remind_time` FROM `reminder_content` WHERE `user_id`=%s AND `remind_time` >= %s ORDER BY `remind_time`"
+				cursor.execute(sql, (user_id, datetime.datetime.now()))
 				remind_content_list = cursor.fetchall()
 				if len(remind_content_list) == 0:
-					line_bot_api.reply_message(
-						event.reply_token,
-						TextSendMessage(text="現在登録されているリマインドはありません"))
+					reply = TextSendMessage(text="現在登録されているリマインドはありません")
 				else:
-					remind_list = ""
-					for content_dict in remind_content_list:
-						remind_content = content_dict["remind_content"]
-						remind_time_dt = content_dict["remind_time"]
-						if remind_time_dt.timestamp()-time.time() < 0:
-							continue
-						else:
-							remind_time = remind_time_dt.strftime("%Y/%m/%d %H:%M")
-							remind_list += f'{remind_time} \n{remind_content}\n\n'
-					if remind_list == "":
-						line_bot_api.reply_message(
-						event.reply_token,
-						TextSendMessage(text="現在登録されているリマインドはありません"))
-					else:
-						remind_list = re.sub("\n\n$","",remind_list)
-						line_bot_api.reply_message(
-							event.reply_token,
-							[TextSendMessage(text=remind_list),
-							TextSendMessage(text="どのリマインドを取り消すか入力して下さい"),
-							TextSendMessage(text="また、同じ内容のリマインドはすべて削除されるので注意して下さい"),
-							TextSendMessage(text="やめたい場合は「キャンセル」を押して下さい",
-							quick_reply=QuickReply(items=[
-                    	    QuickReplyButton(action=MessageAction(label="キャンセル", text="キャンセル"))
-                    	]))])
-						sql = "UPDATE `user_session` SET `status`=2 WHERE `user_id`=%s"
-						cursor.execute(sql, (user_id))
-						connection.commit()
+					remind_list = "\n\n".join(
+						f'{content_dict["remind_time"]:%Y/%m/%d %H:%M} \n{content_dict["remind_content"]}'
+						for content_dict in remind_content_list)
+					reply = [TextSendMessage(text=remind_list),
+						TextSendMessage(text="\n\n".join([
+							"どのリマインドを取り消すか入力して下さい",
+							"また、同じ内容のリマインドはすべて削除されるので注意して下さい",
+							"やめたい場合は「キャンセル」を押して下さい"]),
+						quick_reply=CANCEL_QUICK_REPLY)]
+					sql = "UPDATE `user_session` SET `status`=2 WHERE `user_id`=%s"
+					cursor.execute(sql, (user_id,))
+					update_session_cache(user_id, status=2)
 			else:
 				sql = "INSERT INTO `reminder_content` (`user_id`, `remind_content`, `remind_time`, `text_id`) VALUES (%s, %s, NULL, %s)"
 				cursor.execute(sql, (user_id, text, text_id))
-				connection.commit()
-				now = datetime.datetime.now()
-				line_bot_api.reply_message(
-					event.reply_token,
-					TemplateSendMessage(
-						alt_text="日時選択",
-						template=ButtonsTemplate(
-							text="リマインド日時を選択",
-							actions=[
-								DatetimePickerTemplateAction(
-									label="日時選択",
-									data="id",
-									mode="datetime",
-									initial=(now + datetime.timedelta(hours=1)).strftime("%Y-%m-%dT%H:00"),
-									min=now.strftime("%Y-%m-%dT%H:%M"),
-									max=f"{now.year + 1}-12-31T23:59")]),
-						quick_reply=QuickReply(items=[
-							QuickReplyButton(action=MessageAction(label="キャンセル", text="キャンセル"))])))
-				update_status(user_id,1,text_id)
+				update_status(user_id,1,text_id,cursor)
+				reply = build_datetime_picker()
+	line_bot_api.reply_message(event.reply_token, reply)
 
 def handle_status_1(event):
-	connection = get_connection()
 	user_id = event.source.user_id
 	text = event.message.text
-	text_id = event.message.id
-	with connection:
-		with connection.cursor() as cursor:
-			if text == "キャンセル":
-				sql = "SELECT `text_id` FROM `user_session` WHERE `user_id`=%s"
-				cursor.execute(sql, (user_id))
-				uuid = cursor.fetchone()
+	if text == "キャンセル":
+		connection = get_connection()
+		with connection:
+			with connection.cursor() as cursor:
+				text_id = get_session(user_id, cursor)["text_id"]
 				sql = "DELETE FROM `reminder_content` WHERE `user_id`=%s AND `text_id`=%s"
-				cursor.execute(sql, (user_id, uuid["text_id"]))
-				connection.commit()
-				update_status(user_id,0,None)
-				line_bot_api.reply_message(
-						event.reply_token,
-						TextSendMessage(text="キャンセルしました"))
-			elif text == "再送":
-				now = datetime.datetime.now()
-				line_bot_api.reply_message(
-					event.reply_token,
-					TemplateSendMessage(
-						alt_text="日時選択",
-						template=ButtonsTemplate(
-							text="リマインド日時を選択",
-							actions=[
-								DatetimePickerTemplateAction(
-									label="日時選択",
-									data="id",
-									mode="datetime",
-									initial=(now + datetime.timedelta(hours=1)).strftime("%Y-%m-%dT%H:00"),
-									min=now.strftime("%Y-%m-%dT%H:%M"),
-									max=f"{now.year + 1}-12-31T23:59")]),
-						quick_reply=QuickReply(items=[
-							QuickReplyButton(action=MessageAction(label="キャンセル", text="キャンセル"))])))
-			else:
-				line_bot_api.reply_message(
-						event.reply_token,
-						[TextSendMessage(text="日時選択アクションからリマインドする日時を選択してさい。"),
-						TextSendMessage(text="再送して欲しい場合は「再送」を、キャンセルしたい場合は「キャンセル」を押してください。",
-										quick_reply=QuickReply(items=[
-											QuickReplyButton(action=MessageAction(label="キャンセル", text="キャンセル")),
-											QuickReplyButton(action=MessageAction(label="再送", text="再送"))]))])
+				cursor.execute(sql, (user_id, text_id))
+				update_status(user_id,0,None,cursor)
+		reply = TextSendMessage(text="キャンセルしました")
+	elif text == "再送":
+		reply = build_datetime_picker()
+	else:
+		reply = [TextSendMessage(text="日時選択アクションからリマインドする日時を選択してさい。"),
+			TextSendMessage(text="再送して欲しい場合は「再送」を、キャンセルしたい場合は「キャンセル」を押してください。",
+				quick_reply=CANCEL_OR_RESEND_QUICK_REPLY)]
+	line_bot_api.reply_message(event.reply_token, reply)
 
 def handle_status_2(event):
-	connection = get_connection()
 	user_id = event.source.user_id
 	text = event.message.text
-	with connection:
-		with connection.cursor() as cursor:
-			if text == "キャンセル":
-				update_status(user_id,0,None)
-				line_bot_api.reply_message(
-						event.reply_token,
-						TextSendMessage(text="キャンセルしました"))
-			else:
-				sql = "SELECT * FROM `reminder_content` WHERE `user_id`=%s AND `remind_content`=%s"
-				cursor.execute(sql, (user_id,text))
-				remind_content_list = cursor.fetchall()
-				if len(remind_content_list) == 0:
-					line_bot_api.reply_message(
-						event.reply_token,
-						TextSendMessage(text="存在しないリマインドです\nやめたい場合は「キャンセル」を押して下さい",
-						quick_reply=QuickReply(items=[
-                        QuickReplyButton(action=MessageAction(label="キャンセル", text="キャンセル"))
-                    ])))
+	if text == "キャンセル":
+		update_status(user_id,0,None)
+		reply = TextSendMessage(text="キャンセルしました")
+	else:
+		connection = get_connection()
+		with connection:
+			with connection.cursor() as cursor:
+				sql = "SELECT 1 FROM `reminder_content` WHERE `user_id`=%s AND `remind_content`=%s LIMIT 1"
+				if fetch_scalar(connection, sql, (user_id,text)) is None:
+					reply = TextSendMessage(text="存在しないリマインドです\nやめたい場合は「キャンセル」を押して下さい",
+						quick_reply=CANCEL_QUICK_REPLY)
 				else:
-					sql = "DELETE FROM `reminder_content` WHERE `user_id`=%s AND `remind_content`=%s"
-					cursor.execute(sql, (user_id, text))
-					connection.commit()
-					sql = "UPDATE `user_session` SET `status`=0, `text_id`=NULL WHERE `user_id`=%s"
-					cursor.execute(sql, (user_id))
-					connection.commit()
-					line_bot_api.reply_message(
-						event.reply_token,
-						TextSendMessage(text="取り消しが出来ました!"))
+					connection.begin()
+					try:
+						sql = "DELETE FROM `reminder_content` WHERE `user_id`=%s AND `remind_content`=%s"
+						cursor.execute(sql, (user_id, text))
+						sql = "UPDATE `user_session` SET `status`=0, `text_id`=NULL WHERE `user_id`=%s"
+						cursor.execute(sql, (user_id,))
+						connection.commit()
+					except Exception:
+						connection.rollback()
+						raise
+					update_session_cache(user_id, status=0, text_id=None)
+					reply = TextSendMessage(text="取り消しが出来ました!")
+	line_bot_api.reply_message(event.reply_token, reply)
+
+def picker_args(now=None):
+	# 日時選択アクションのinitial, min, max
+	now = now or datetime.datetime.now()
+	return ((now + datetime.timedelta(hours=1)).strftime("%Y-%m-%dT%H:00"),
+			now.strftime("%Y-%m-%dT%H:%M"),
+			f"{now.year + 1}-12-31T23:59")
+
+def build_datetime_picker():
+	initial, min_time, max_time = picker_args()
+	return TemplateSendMessage(
+		alt_text="日時選択",
+		template=ButtonsTemplate(
+			text="リマインド日時を選択",
+			actions=[
+				DatetimePickerTemplateAction(
+					label="日時選択",
+					data="id",
+					mode="datetime",
+					initial=initial,
+					min=min_time,
+					max=max_time)]),
+		quick_reply=CANCEL_QUICK_REPLY)
 
 def get_connection():
-	return pymysql.connect(host=os.environ["NS_MARIADB_HOSTNAME"],
-							port=int(os.environ["NS_MARIADB_PORT"]),
-							user=os.environ["NS_MARIADB_USER"],
-                            password=os.environ["NS_MARIADB_PASSWORD"],
-                            db=os.environ["NS_MARIADB_DATABASE"],
-                            charset='utf8mb4',
-                            cursorclass=pymysql.cursors.DictCursor)
-
-def update_status(user_id,status,text_id):
-	connection = get_connection()
-	with connection:
-		with connection.cursor() as cursor:
-			sql = "UPDATE `user_session` SET `status`=%s, `text_id`=%s WHERE `user_id`=%s"
-			cursor.execute(sql, (status,text_id,user_id))
-			connection.commit()
+	return pool.get_connection(retry_num=2, retry_interval=1)
+
+def fetch_scalar(connection, sql, args):
+	# 1列だけ読むときは行ごとにdictを作らないようタプルのカーソルを使う
+	with connection.cursor(pymysql.cursors.Cursor) as cursor:
+		cursor.execute(sql, args)
+		row = cursor.fetchone()
+	return None if row is None else row[0]
+
+def get_session(user_id, cursor=None):
+	with session_cache_lock:
+		user_session = session_cache.get(user_id)
+		generation = session_generation
+	if user_session is None:
+		if cursor is None:
+			connection = get_connection()
+			with connection:
+				with connection.cursor() as cursor:
+					return get_session(user_id, cursor)
+		sql = "SELECT `status`, `text_id`, `last_notify_text_id` FROM `user_session` WHERE `user_id`=%s"
+		cursor.execute(sql, (user_id,))
+		user_session = cursor.fetchone()
+		if user_session is not None:
+			with session_cache_lock:
+				if generation == session_generation:
+					session_cache[user_id] = user_session
+	return user_session
+
+def set_session(user_id, user_session):
+	global session_generation
+	with session_cache_lock:
+		session_generation += 1
+		session_cache[user_id] = user_session
+
+def update_session_cache(user_id, **values):
+	global session_generation
+	with session_cache_lock:
+		session_generation += 1
+		if user_id in session_cache:
+			session_cache[user_id] = {**session_cache[user_id], **values}
+
+def delete_session(user_id):
+	global session_generation
+	with session_cache_lock:
+		session_generation += 1
+		session_cache.pop(user_id, None)
+
+def update_status(user_id,status,text_id,cursor=None):
+	if cursor is None:
+		connection = get_connection()
+		with connection:
+			with connection.cursor() as cursor:
+				return update_status(user_id,status,text_id,cursor)
+	sql = "UPDATE `user_session` SET `status`=%s, `text_id`=%s WHERE `user_id`=%s"
+	cursor.execute(sql, (status,text_id,user_id))
+	update_session_cache(user_id, status=status, text_id=text_id)
 
 def snooze_remind(event):
 	connection = get_connection()
@@ -349,118 +376,120 @@ def snooze_remind(event):
 	text_id = event.message.id
 	with connection:
 		with connection.cursor() as cursor:
-			sql = "SELECT `last_notify_text_id` FROM `user_session` WHERE `user_id`=%s"
-			cursor.execute(sql, (user_id))
-			last_notify_text_id_for_snooze = cursor.fetchone()
-			last_notify_text_id_for_snooze = last_notify_text_id_for_snooze["last_notify_text_id"]
+			last_notify_text_id_for_snooze = get_session(user_id, cursor)["last_notify_text_id"]
 			if last_notify_text_id_for_snooze is None:
-				line_bot_api.reply_message(
-					event.reply_token,
-					TextSendMessage(text="リマインド履歴が確認出来なかったため、スヌーズに失敗しました"))
+				reply = TextSendMessage(text="リマインド履歴が確認出来なかったため、スヌーズに失敗しました")
 			else:
 				sql = "SELECT `remind_content` FROM `reminder_content` WHERE `user_id`=%s AND `text_id`=%s"
-				cursor.execute(sql, (user_id,last_notify_text_id_for_snooze))
-				remind_content_for_snooze = cursor.fetchone()
+				remind_content_for_snooze = fetch_scalar(connection, sql, (user_id,last_notify_text_id_for_snooze))
 				if remind_content_for_snooze is None:
-					line_bot_api.reply_message(
-						event.reply_token,
-						TextSendMessage(text="何らかの事情で履歴を遡れなかったため、スヌーズに失敗しました"))
+					reply = TextSendMessage(text="何らかの事情で履歴を遡れなかったため、スヌーズに失敗しました")
 				else:
-					remind_content_for_snooze = remind_content_for_snooze["remind_content"]
-					for job in schedule.jobs:
-						if all(x in str(job) for x in ("delete_history", user_id, last_notify_text_id_for_snooze)):
-							schedule.cancel_job(job)
-							break
-					sql = "DELETE FROM `reminder_content` WHERE `user_id`=%s AND `text_id`=%s"
-					cursor.execute(sql, (user_id, last_notify_text_id_for_snooze))
-					connection.commit()
-					sql = "INSERT INTO `reminder_content` (`user_id`, `remind_content`, `remind_time`, `text_id`) VALUES (%s, %s, NULL, %s)"
-					cursor.execute(sql, (user_id, remind_content_for_snooze, text_id))
-					connection.commit()
-					update_status(user_id,1,text_id)
-					now = datetime.datetime.now()
-					line_bot_api.reply_message(
-							event.reply_token,
-							[TextSendMessage(text=f"「{remind_content_for_snooze}」のスヌーズに成功しました。"),
-							TemplateSendMessage(
-								alt_text="日時選択",
-								template=ButtonsTemplate(
-									text="リマインド日時を選択",
-									actions=[
-										DatetimePickerTemplateAction(
-											label="日時選択",
-											data="id",
-											mode="datetime",
-											initial=(now + datetime.timedelta(hours=1)).strftime("%Y-%m-%dT%H:00"),
-											min=now.strftime("%Y-%m-%dT%H:%M"),
-											max=f"{now.year + 1}-12-31T23:59")]),
-								quick_reply=QuickReply(items=[
-									QuickReplyButton(action=MessageAction(label="キャンセル", text="キャンセル"))]))])
+					connection.begin()
+					try:
+						sql = "DELETE FROM `reminder_content` WHERE `user_id`=%s AND `text_id`=%s"
+						cursor.execute(sql, (user_id, last_notify_text_id_for_snooze))
+						sql = "INSERT INTO `reminder_content` (`user_id`, `remind_content`, `remind_time`, `text_id`) VALUES (%s, %s, NULL, %s)"
+						cursor.execute(sql, (user_id, remind_content_for_snooze, text_id))
+						connection.commit()
+					except Exception:
+						connection.rollback()
+						raise
+					job = delete_jobs.pop((user_id, last_notify_text_id_for_snooze), None)
+					if job is not None:
+						try:
+							scheduler.cancel(job)
+						except ValueError:
+							# 既に実行が始まっている
+							pass
+					update_status(user_id,1,text_id,cursor)
+					reply = [TextSendMessage(text=f"「{remind_content_for_snooze}」のスヌーズに成功しました。"),
+						build_datetime_picker()]
+	line_bot_api.reply_message(event.reply_token, reply)
 
 def delete_history(user_id,text_id):
+	delete_jobs.pop((user_id, text_id), None)
 	connection = get_connection()
 	with connection:
 		with connection.cursor() as cursor:
 			sql = "DELETE FROM `reminder_content` WHERE `user_id`=%s AND `text_id`=%s"
 			cursor.execute(sql, (user_id, text_id))
-			connection.commit()
-	return schedule.CancelJob
 
 def remind(text_id,user_id):
+	connection = get_connection()
+	with connection:
+		sql = "SELECT `remind_content` FROM `reminder_content` WHERE `user_id`=%s AND `text_id`=%s"
+		remind_content = fetch_scalar(connection, sql, (user_id,text_id))
+	if remind_content is None:
+		# 通知前に取り消されたリマインド
+		return
+	line_bot_api.push_message(user_id, TextSendMessage(text=f'「{remind_content}」の時間です',
+	quick_reply=SNOOZE_QUICK_REPLY))
+	delete_jobs[(user_id, text_id)] = add_job(time.time()+86400, run_background, (delete_history, user_id, text_id))
 	connection = get_connection()
 	with connection:
 		with connection.cursor() as cursor:
-			sql = "SELECT `remind_content` FROM `reminder_content` WHERE `user_id`=%s AND `text_id`=%s"
-			cursor.execute(sql, (user_id,text_id))
-			remind_content = cursor.fetchone()
-			line_bot_api.push_message(user_id, TextSendMessage(text=f'「{remind_content["remind_content"]}」の時間です',
-			quick_reply=QuickReply(items=[
-                        QuickReplyButton(action=MessageAction(label="スヌーズ", text="スヌーズ"))
-                    ])))
-			schedule.every(86400).seconds.do(delete_history,user_id,text_id)
 			sql = "UPDATE `user_session` SET `last_notify_text_id`=%s WHERE `user_id`=%s"
 			cursor.execute(sql, (text_id,user_id))
-			connection.commit()
-	return schedule.CancelJob
+			update_session_cache(user_id, last_notify_text_id=text_id)
 
 def send_message(user_id,message_text):
 	line_bot_api.push_message(user_id, TextSendMessage(text=message_text))
 
+def run_background(func, *args):
+	# futureの結果は誰も見ないので、例外はここでログに残す
+	def run():
+		try:
+			func(*args)
+		except Exception:
+			app.logger.exception("%s%s failed", func.__name__, args)
+	return push_executor.submit(run)
+
+def add_job(run_time, action, argument):
+	job = scheduler.enterabs(run_time, 1, action, argument)
+	wake.set()
+	return job
+
 def app_run():
 	app.run(host="0.0.0.0", port=8080)
 
 def schedule_func():
 	while True:
-		print("schedule working...")
-		print(schedule.get_jobs())
-		schedule.run_pending()
-		time.sleep(5)
+		scheduler.run()
+		wait_for_job(None)
+
+def create_index():
+	# 既存のDBにもsql/1_init.sqlと同じインデックスを張る
+	connection = get_connection()
+	with connection:
+		with connection.cursor() as cursor:
+			cursor.execute("CREATE INDEX IF NOT EXISTS `idx_user` ON `user_session` (`user_id`)")
+			cursor.execute("CREATE INDEX IF NOT EXISTS `idx_user_time` ON `reminder_content` (`user_id`, `remind_time`)")
+			cursor.execute("CREATE INDEX IF NOT EXISTS `idx_user_textid` ON `reminder_content` (`user_id`, `text_id`)")
+			cursor.execute("CREATE INDEX IF NOT EXISTS `idx_user_content` ON `reminder_content` (`user_id`, `remind_content`(255))")
 
 def re_schedule():
 	connection = get_connection()
 	with connection:
 		with connection.cursor() as cursor:
-			sql = "SELECT * FROM `reminder_content`"
-			cursor.execute(sql)
+			# DBのタイムゾーンに依存しないよう、NOW()ではなくアプリ側の現在時刻で比較する
+			now = datetime.datetime.now()
+			sql = "DELETE FROM `reminder_content` WHERE `remind_time` < %s"
+			cursor.execute(sql, (now,))
+			sql = "SELECT `user_id`, `text_id`, `remind_time` FROM `reminder_content` WHERE `remind_time` >= %s"
+			cursor.execute(sql, (now,))
 			remind_list = cursor.fetchall()
 			for remind_dict in remind_list:
-				remind_time_dt = remind_dict["remind_time"]
-				if remind_time_dt is None:
-					continue
-				user_id = remind_dict["user_id"]
-				text_id = remind_dict["text_id"]
-				remind_time_sec = remind_time_dt.timestamp()-time.time()
-				if remind_time_sec < 0:
-					sql = "DELETE FROM `reminder_content` WHERE `user_id`=%s AND `text_id`=%s"
-					cursor.execute(sql, (user_id, text_id))
-					connection.commit()
-				else:
-					schedule.every(remind_time_sec).seconds.do(remind,text_id,user_id)
+				add_job(remind_dict["remind_time"].timestamp(), run_background, (remind, remind_dict["text_id"], remind_dict["user_id"]))
 
-if __name__ == "__main__":
-	my_user_id = os.environ["MY_USER_ID"]
+def start_scheduler(notify=True):
+	create_index()
 	re_schedule()
-	send_message(my_user_id, "デプロイが完了しました")
-	with ThreadPoolExecutor(2) as executor:
-		executor.submit(app_run)
-		executor.submit(schedule_func)
\ No newline at end of file
+	threading.Thread(target=schedule_func, daemon=True).start()
+	# LINE APIの失敗でワーカーの起動が止まらないよう、通知はバックグラウンドで送る
+	if notify:
+		run_background(send_message, my_user_id, "デプロイが完了しました")
+
+if __name__ == "__main__":
+	start_scheduler()
+	app_run()
\ No newline at end of file
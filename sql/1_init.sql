@@ -2,12 +2,16 @@ CREATE TABLE `user_session` (
     `user_id` VARCHAR(255) NOT NULL,
 	`text_id` VARCHAR(255),
 	`last_notify_text_id` VARCHAR(255),
-    `status` INT NOT NULL
+    `status` INT NOT NULL,
+    INDEX `idx_user` (`user_id`)
 );
 
 CREATE TABLE `reminder_content` (
     `user_id` VARCHAR(255) NOT NULL,
     `remind_content` TEXT,
     `remind_time` DATETIME,
-    `text_id` VARCHAR(255) 
+    `text_id` VARCHAR(255),
+    INDEX `idx_user_time` (`user_id`, `remind_time`),
+    INDEX `idx_user_textid` (`user_id`, `text_id`),
+    INDEX `idx_user_content` (`user_id`, `remind_content`(255))
 );
\ No newline at end of file